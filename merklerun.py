@@ -1,341 +1,795 @@
-
-
-"""
-https://github.com/Avimuller1102
-
-merkle-run: tamper-evident, deterministic runner for python scripts (no root)
-
-usage:
-  python merklerun.py run path/to/target.py --args "foo bar" --seed 42 --allow-net 0
-  python merklerun.py verify path/to/target.py manifest.json --seed 42 --allow-net 0
-  python merklerun.py diff manifest_a.json manifest_b.json
-"""
-
-import argparse
-import builtins
-import functools
-import hashlib
-import importlib.util
-import io
-import json
-import os
-import random
-import runpy
-import socket
-import subprocess
-import sys
-import time
-import types
-from datetime import datetime
-from typing import Any, Dict, List, Optional, Tuple
-
-# ------------------------------
-# event logger with merkle chain
-# ------------------------------
-
-
-class EventLogger:
-    # all comments are in lowercase on purpose, as requested.
-    def __init__(self, seed: int, allow_net: bool):
-        # start timestamp and monotonic base for stable timing deltas
-        self.start_wall = datetime.utcnow().isoformat() + "Z"
-        self.start_mono = time.monotonic()
-        self.events: List[Dict[str, Any]] = []
-        self.prev_hash = "0" * 64
-        self.seed = seed
-        self.allow_net = allow_net
-        # capture minimal environment snapshot for context
-        self.env = {
-            "python_version": sys.version,
-            "platform": sys.platform,
-            "cwd": os.getcwd(),
-        }
-
-    def _hash_dict(self, d: Dict[str, Any]) -> str:
-        # hash json deterministically
-        payload = json.dumps(d, sort_keys=True, separators=(",", ":")).encode()
-        return hashlib.sha256(payload).hexdigest()
-
-    def _chain(self, event: Dict[str, Any]) -> str:
-        # add merkle-like chaining by hashing previous hash + event hash
-        h_event = self._hash_dict(event)
-        combined = (self.prev_hash + h_event).encode()
-        h_chain = hashlib.sha256(combined).hexdigest()
-        self.prev_hash = h_chain
-        return h_chain
-
-    def log(self, kind: str, **fields):
-        # compute relative time for readability
-        rel = time.monotonic() - self.start_mono
-        event = {"t": round(rel, 6), "kind": kind, **fields}
-        h = self._chain(event)
-        event["chain"] = h
-        self.events.append(event)
-
-    def manifest(self) -> Dict[str, Any]:
-        # build final manifest with a root hash
-        root = {
-            "started_at_utc": self.start_wall,
-            "seed": self.seed,
-            "allow_net": self.allow_net,
-            "env": self.env,
-            "events": self.events,
-        }
-        root["root_hash"] = self._hash_dict({"events": self.events})
-        return root
-    
-
-# -----------------------------------
-# monkeypatches for io/net/subprocess
-# -----------------------------------
-
-class IOShim:
-    # a file wrapper that updates a hasher on writes and records size
-    def __init__(self, f, path, mode, logger: EventLogger):
-        self._f = f
-        self._path = path
-        self._mode = mode
-        self._logger = logger
-        self._written = 0
-        self._hasher = hashlib.sha256()
-
-    def write(self, b):
-        # support str and bytes
-        if isinstance(b, str):
-            b = b.encode()
-        self._written += len(b)
-        self._hasher.update(b)
-        return self._f.write(b)
-
-    def writelines(self, lines):
-        # collect everything through write for hashing
-        total = 0
-        for line in lines:
-            total += self.write(line)
-        return total
-
-    def close(self):
-        try:
-            return self._f.close()
-        finally:
-            if "w" in self._mode or "a" in self._mode or "x" in self._mode:
-                self._logger.log(
-                    "file_write_close",
-                    path=os.path.abspath(self._path),
-                    bytes=self._written,
-                    sha256=self._hasher.hexdigest(),
-                )
-
-    def __getattr__(self, name):
-        # forward other attributes (read, flush, etc.)
-        return getattr(self._f, name)
-
-def hash_file(path: str) -> Tuple[int, str]:
-    # hash file content without loading all in memory
-    h = hashlib.sha256()
-    size = 0
-    with open(path, "rb") as rf:
-        while True:
-            chunk = rf.read(1024 * 1024)
-            if not chunk:
-                break
-            size += len(chunk)
-            h.update(chunk)
-    return size, h.hexdigest()
-
-def patch_open(logger: EventLogger):
-    original_open = builtins.open
-
-    def open_wrapper(path, mode="r", *args, **kwargs):
-        abspath = os.path.abspath(path)
-        # on read, hash the current file content immediately (determinism)
-        if "r" in mode and os.path.exists(abspath) and "b" in mode:
-            size, sha = hash_file(abspath)
-            logger.log("file_open_read", path=abspath, mode=mode, bytes=size, sha256=sha)
-        elif "r" in mode and os.path.exists(abspath) and "b" not in mode:
-            # if text mode read, still compute hash on bytes for stability
-            size, sha = hash_file(abspath)
-            logger.log("file_open_read", path=abspath, mode=mode, bytes=size, sha256=sha)
-        else:
-            logger.log("file_open", path=abspath, mode=mode)
-
-        f = original_open(path, mode, *args, **kwargs)
-        # if writing, wrap to collect hash of written bytes
-        if any(m in mode for m in ("w", "a", "x")):
-            return IOShim(f, path, mode, logger)
-        return f
-
-    builtins.open = open_wrapper
-    return original_open
-
-def patch_socket(logger: EventLogger, allow_net: bool):
-    original_socket = socket.socket
-
-    class SocketShim(socket.socket):
-        def connect(self, address):
-            # block or log network according to policy
-            host, port = address[0], address[1]
-            if not allow_net:
-                logger.log("net_block", host=host, port=port)
-                raise PermissionError("network disabled by merkle-run")
-            logger.log("net_connect", host=host, port=port)
-            return super().connect(address)
-
-        def send(self, data, *args, **kwargs):
-            if not allow_net:
-                logger.log("net_block_send", bytes=len(data))
-                raise PermissionError("network disabled by merkle-run")
-            sha = hashlib.sha256(data if isinstance(data, (bytes, bytearray)) else str(data).encode()).hexdigest()
-            logger.log("net_send", bytes=len(data), sha256=sha)
-            return super().send(data, *args, **kwargs)
-
-        def recv(self, bufsize, *args, **kwargs):
-            if not allow_net:
-                logger.log("net_block_recv", req=bufsize)
-                raise PermissionError("network disabled by merkle-run")
-            data = super().recv(bufsize, *args, **kwargs)
-            sha = hashlib.sha256(data).hexdigest()
-            logger.log("net_recv", bytes=len(data), sha256=sha)
-            return data
-
-    socket.socket = SocketShim
-    return original_socket
-
-def patch_subprocess(logger: EventLogger):
-    original_popen = subprocess.Popen
-
-    class PopenShim(subprocess.Popen):
-        def __init__(self, args, *pargs, **kwargs):
-            # normalize args to a printable form
-            cmd = args if isinstance(args, list) else [str(args)]
-            logger.log("subprocess_spawn", cmd=" ".join(map(str, cmd)))
-            super().__init__(args, *pargs, **kwargs)
-
-    subprocess.Popen = PopenShim
-    return original_popen
-
-def seed_all(seed: int, logger: EventLogger):
-    # fix python's prng; try numpy if present
-    random.seed(seed)
-    logger.log("rng_seed", lib="random", seed=seed)
-    try:
-        import numpy as np  # type: ignore
-        np.random.seed(seed)
-        logger.log("rng_seed", lib="numpy", seed=seed)
-    except Exception:
-        logger.log("rng_seed_skip", lib="numpy")
-
-# ----------------
-# core run/verify
-# ----------------
-
-def run_instrumented(target: str, args_line: Optional[str], seed: int, allow_net: bool) -> Dict[str, Any]:
-    logger = EventLogger(seed=seed, allow_net=allow_net)
-
-    # apply patches
-    undo_open = patch_open(logger)
-    undo_sock = patch_socket(logger, allow_net)
-    undo_popen = patch_subprocess(logger)
-    seed_all(seed, logger)
-
-    # prepare argv for the target script
-    old_argv = sys.argv[:]
-    sys.argv = [target] + (args_line.split() if args_line else [])
-
-    try:
-        # run the target in its own globals using runpy
-        logger.log("begin", target=os.path.abspath(target), args=sys.argv[1:])
-        runpy.run_path(target, run_name="__main__")
-        logger.log("end", status="ok")
-    except Exception as e:
-        # log exception type and message (not stack) to keep manifest stable
-        logger.log("end", status="exception", error=repr(e))
-        raise
-    finally:
-        # restore patches
-        builtins.open = undo_open
-        socket.socket = undo_sock
-        subprocess.Popen = undo_popen
-        sys.argv = old_argv
-
-    return logger.manifest()
-
-def verify_run(target: str, ref_manifest_path: str, seed: int, allow_net: bool) -> Dict[str, Any]:
-    # load reference manifest
-    with open(ref_manifest_path, "r", encoding="utf-8") as f:
-        ref = json.load(f)
-
-    now = run_instrumented(target, args_line=" ".join(ref.get("events", [{}])[0].get("args", [])) if ref.get("events") else None,
-                           seed=seed, allow_net=allow_net)
-
-    # compare event sequence shape and critical fields
-    diffs = []
-    a, b = ref["events"], now["events"]
-    n = min(len(a), len(b))
-    for i in range(n):
-        ea, eb = a[i], b[i]
-        if ea["kind"] != eb["kind"]:
-            diffs.append({"index": i, "field": "kind", "ref": ea["kind"], "now": eb["kind"]})
-            continue
-        # compare selected fields when present
-        for key in ("path", "sha256", "bytes", "cmd", "host", "port"):
-            va, vb = ea.get(key), eb.get(key)
-            if va != vb:
-                diffs.append({"index": i, "field": key, "ref": va, "now": vb})
-    if len(a) != len(b):
-        diffs.append({"index": "len", "ref": len(a), "now": len(b)})
-
-    return {"ok": len(diffs) == 0, "diffs": diffs, "reference_root": ref.get("root_hash"), "now_root": now.get("root_hash")}
-
-# ------------
-# handy cli
-# ------------
-
-def main():
-    parser = argparse.ArgumentParser(description="merkle-run: deterministic, tamper-evident runner")
-    sub = parser.add_subparsers(dest="cmd", required=True)
-
-    p_run = sub.add_parser("run", help="run a script and emit manifest.json")
-    p_run.add_argument("target")
-    p_run.add_argument("--args", default=None, help="args passed to target script (single string)")
-    p_run.add_argument("--seed", type=int, default=1337)
-    p_run.add_argument("--allow-net", type=int, default=0)
-    p_run.add_argument("--out", default="manifest.json")
-
-    p_ver = sub.add_parser("verify", help="re-run script and compare against a reference manifest")
-    p_ver.add_argument("target")
-    p_ver.add_argument("reference_manifest")
-    p_ver.add_argument("--seed", type=int, default=1337)
-    p_ver.add_argument("--allow-net", type=int, default=0)
-
-    p_diff = sub.add_parser("diff", help="compare two manifests")
-    p_diff.add_argument("a")
-    p_diff.add_argument("b")
-
-    args = parser.parse_args()
-
-    if args.cmd == "run":
-        manifest = run_instrumented(args.target, args.args, seed=args.seed, allow_net=bool(args.allow_net))
-        with open(args.out, "w", encoding="utf-8") as f:
-            json.dump(manifest, f, indent=2, sort_keys=True)
-        print(f"wrote {args.out} with root_hash {manifest['root_hash']}")
-    elif args.cmd == "verify":
-        result = verify_run(args.target, args.reference_manifest, seed=args.seed, allow_net=bool(args.allow_net))
-        print(json.dumps(result, indent=2, sort_keys=True))
-        if not result["ok"]:
-            sys.exit(2)
-    elif args.cmd == "diff":
-        with open(args.a, "r", encoding="utf-8") as fa, open(args.b, "r", encoding="utf-8") as fb:
-            A, B = json.load(fa), json.load(fb)
-        print("root a:", A.get("root_hash"))
-        print("root b:", B.get("root_hash"))
-        # simple diff by event count and kinds
-        kinds_a = [e["kind"] for e in A.get("events", [])]
-        kinds_b = [e["kind"] for e in B.get("events", [])]
-        print("len a:", len(kinds_a), "len b:", len(kinds_b))
-        for i, (ka, kb) in enumerate(zip(kinds_a, kinds_b)):
-            if ka != kb:
-                print(f"@{i}: {ka} != {kb}")
-
-if __name__ == "__main__":
-    main()
+
+
+"""
+https://github.com/Avimuller1102
+
+merkle-run: tamper-evident, deterministic runner for python scripts (no root)
+
+usage:
+  python merklerun.py run path/to/target.py --args "foo bar" --seed 42 --allow-net 0
+  python merklerun.py verify path/to/target.py manifest.json --seed 42 --allow-net 0
+  python merklerun.py diff manifest_a.json manifest_b.json
+"""
+
+import argparse
+import builtins
+import concurrent.futures
+import functools
+import hashlib
+import importlib.util
+import io
+import json
+import mmap
+import os
+import random
+import runpy
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import types
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+# pick the fastest sha256 backend available. openssl's implementation uses
+# sha-ni on modern cpus (2-5x faster than the generic c code); cpython exposes
+# it through _hashlib when linked against openssl. users on older openssl
+# builds can force the sha-ni path with the OPENSSL_ia32cap env var (see readme).
+try:
+    import _hashlib
+    _sha256_new = _hashlib.openssl_sha256
+except (ImportError, AttributeError):
+    _sha256_new = hashlib.sha256
+
+# clone a preconstructed hasher instead of running the constructor per call:
+# copy() is a single memcpy of the state block, which is cheaper than state
+# init on openssl backends and adds up across thousands of events
+_SHA256_PROTO = _sha256_new()
+
+def _sha256(data=b""):
+    h = _SHA256_PROTO.copy()
+    if data:
+        h.update(data)
+    return h
+
+# canonical json serializer for hashing: orjson emits sorted-key compact
+# bytes straight from c when installed; stdlib encoder otherwise. the
+# fallback uses ensure_ascii=False so both encoders emit raw utf-8 and
+# produce the same bytes (hence the same hashes); the manifest records
+# which one ran so any residual divergence is attributable.
+try:
+    import orjson
+
+    def _dumps(d: Dict[str, Any]) -> bytes:
+        return orjson.dumps(d, option=orjson.OPT_SORT_KEYS)
+    _JSON_ENCODER = "orjson"
+except ImportError:
+    def _dumps(d: Dict[str, Any]) -> bytes:
+        return json.dumps(d, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode()
+    _JSON_ENCODER = "json"
+
+# canonical byte form for hashing: cbor with canonical key ordering is
+# shorter and cheaper to encode than json (fewer bytes into sha256); fall
+# back to canonical json when cbor2 is missing. the manifest records which
+# form produced its hashes so mismatched setups are visible at verify time.
+try:
+    import cbor2
+
+    def _canonical(d: Dict[str, Any]) -> bytes:
+        return cbor2.dumps(d, canonical=True)
+    _CANONICAL_FORM = "cbor"
+except ImportError:
+    _canonical = _dumps
+    _CANONICAL_FORM = "json"
+
+@functools.lru_cache(maxsize=4096)
+def _sha256_hex(payload: bytes) -> str:
+    # many event payloads repeat byte-for-byte (same path+mode opens, seed
+    # skips), so memoize their digests; a miss only costs one dict lookup
+    return _sha256(payload).hexdigest()
+
+# abspath without a getcwd syscall per open: cache the cwd and let
+# run_instrumented invalidate it when the target calls os.chdir
+_cwd_cache: Optional[str] = None
+
+def _abspath(path) -> str:
+    global _cwd_cache
+    if not isinstance(path, str):
+        return os.path.abspath(path)
+    if os.path.isabs(path):
+        return os.path.normpath(path)
+    if _cwd_cache is None:
+        _cwd_cache = os.getcwd()
+    return os.path.normpath(os.path.join(_cwd_cache, path))
+
+def _invalidate_cwd_cache():
+    global _cwd_cache
+    _cwd_cache = None
+
+# ------------------------------
+# event logger with merkle chain
+# ------------------------------
+
+
+@dataclass(slots=True)
+class Event:
+    # compact slotted record for the in-memory log: far less heap than a
+    # per-event dict; the json form is only materialized at manifest() time
+    t: int
+    kind: str
+    chain: str
+    fields: Dict[str, Any]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"t": self.t, "kind": self.kind, **self.fields, "chain": self.chain}
+
+
+class EventLogger:
+    # all comments are in lowercase on purpose, as requested.
+    def __init__(self, seed: int, allow_net: bool, stream=None):
+        # start timestamp and monotonic base for stable timing deltas
+        self.start_wall = datetime.utcnow().isoformat() + "Z"
+        self.start_mono_ns = time.monotonic_ns()
+        self.events: List[Event] = []
+        self.prev_hash = "0" * 64
+        # rolling hasher seeded with the previous chain hash; copied per event
+        # so we pay one constructor per event instead of two
+        self._chain_hasher = _sha256(bytes.fromhex(self.prev_hash))
+        # streaming merkle tree over event hashes: frontier[i] is the root of
+        # a full subtree of 2**i leaves (or None), like bitcoin's accumulator;
+        # each leaf costs o(log n) combines instead of o(n) at the end
+        self._frontier: List[Optional[bytes]] = []
+        self._leaf_count = 0
+        self.seed = seed
+        self.allow_net = allow_net
+        # worker pool for file hashing: hashlib releases the gil on large
+        # updates, so independent reads hash in parallel across cores
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+        # staged events awaiting finalization: log() and defer_hash() append
+        # in call order (which is chronological), and entries are chained as
+        # soon as everything before them is final, so deferred hash events
+        # land in their true position instead of after "end"
+        self._staged: "deque[tuple]" = deque()
+        # hashes of files this run wrote, so a read-back can reuse the write
+        # hash instead of re-reading the file: {abspath: (bytes, sha, mtime_ns)}
+        self._written_hashes: Dict[str, Tuple[int, str, int]] = {}
+        # optional output file to stream events into as they are logged,
+        # instead of one big pretty-printed json.dump at the end
+        self._stream = stream
+        self._streamed = 0
+        if stream is not None:
+            stream.write('{\n"events": [\n')
+        # capture minimal environment snapshot for context
+        self.env = {
+            "python_version": sys.version,
+            "platform": sys.platform,
+            "cwd": os.getcwd(),
+        }
+
+    def _chain(self, event: Dict[str, Any]) -> str:
+        # add merkle-like chaining by folding the event hash into a rolling hasher;
+        # copying the seeded state avoids a second constructor and the string concat
+        h_event = _sha256_hex(_canonical(event))
+        self._merkle_add(bytes.fromhex(h_event))
+        h = self._chain_hasher.copy()
+        h.update(h_event.encode())
+        h_chain = h.hexdigest()
+        self.prev_hash = h_chain
+        self._chain_hasher = _sha256(bytes.fromhex(h_chain))
+        return h_chain
+
+    def _merkle_add(self, node: bytes):
+        # carry-propagate the new leaf: whenever two subtrees of equal size
+        # meet, combine them and try the next level up
+        i = 0
+        while i < len(self._frontier) and self._frontier[i] is not None:
+            node = _sha256(self._frontier[i] + node).digest()
+            self._frontier[i] = None
+            i += 1
+        if i == len(self._frontier):
+            self._frontier.append(node)
+        else:
+            self._frontier[i] = node
+        self._leaf_count += 1
+
+    def merkle_root(self) -> Optional[str]:
+        # fold the remaining subtrees from the smallest up, matching how the
+        # tree would close if padded to completion
+        node = None
+        for sub in self._frontier:
+            if sub is None:
+                continue
+            node = sub if node is None else _sha256(sub + node).digest()
+        return node.hex() if node is not None else None
+
+    def log(self, kind: str, **fields):
+        # relative time in integer nanoseconds: monotonic_ns skips the float
+        # conversion and rounding of time.monotonic, and never jitters
+        self._staged.append((time.monotonic_ns() - self.start_mono_ns, kind, fields, None))
+        self._drain_ready()
+
+    def _record(self, t: int, kind: str, fields: Dict[str, Any]):
+        # the chain hash covers the event without its own chain value
+        chain = self._chain({"t": t, "kind": kind, **fields})
+        event = Event(t, kind, chain, fields)
+        self.events.append(event)
+        if self._stream is not None:
+            # one compact json line per event, written as it happens
+            prefix = ",\n" if self._streamed else ""
+            self._stream.write(prefix + json.dumps(event.to_dict(), sort_keys=True))
+            self._streamed += 1
+
+    def defer_hash(self, kind: str, fn, **fields):
+        # run a (size, sha256) job on the worker pool; the timestamp is taken
+        # now so the event keeps the position at which it fired
+        rel_ns = time.monotonic_ns() - self.start_mono_ns
+        self._staged.append((rel_ns, kind, fields, self._executor.submit(fn)))
+
+    def _drain_ready(self):
+        # chain staged events from the head while they are final, so the log
+        # stays chronological without blocking on outstanding hashes
+        while self._staged:
+            t, kind, fields, fut = self._staged[0]
+            if fut is not None and not fut.done():
+                break
+            self._staged.popleft()
+            self._record(t, kind, self._resolve(fields, fut))
+
+    def _resolve(self, fields: Dict[str, Any], fut) -> Dict[str, Any]:
+        if fut is None:
+            return fields
+        # with the descriptor pinned at open time a failed job is a real i/o
+        # error, not a racing unlink; a manifest missing a hash would verify
+        # as tamper-evident anyway, so fail the run instead of degrading
+        size, sha = fut.result()
+        return {**fields, "bytes": size, "sha256": sha}
+
+    def flush(self):
+        # finalize every staged event in order, blocking on pending hashes
+        staged, self._staged = self._staged, deque()
+        for t, kind, fields, fut in staged:
+            self._record(t, kind, self._resolve(fields, fut))
+
+    def manifest(self) -> Dict[str, Any]:
+        # build final manifest with a root hash
+        self.flush()
+        root = {
+            "started_at_utc": self.start_wall,
+            "seed": self.seed,
+            "allow_net": self.allow_net,
+            "env": self.env,
+            "canonicalization": _CANONICAL_FORM,
+            "json_encoder": _JSON_ENCODER,
+            "events": [e.to_dict() for e in self.events],
+        }
+        # the chain head already commits to every event in order, so reuse it
+        # instead of re-serializing and re-hashing the whole event list
+        root["root_hash"] = self.prev_hash
+        # tree root over the same event hashes; enables o(log n) inclusion
+        # proofs where the chain head only supports full replay
+        root["merkle_root"] = self.merkle_root()
+        if self._stream is not None:
+            # close the streamed event array and append the header fields,
+            # producing the same json-loadable manifest shape
+            header = ",\n".join(
+                "{}: {}".format(json.dumps(k), json.dumps(v, sort_keys=True))
+                for k, v in root.items() if k != "events"
+            )
+            self._stream.write("\n],\n" + header + "\n}\n")
+        return root
+    
+
+# -----------------------------------
+# monkeypatches for io/net/subprocess
+# -----------------------------------
+
+class IOShim:
+    # a file wrapper that updates a hasher on writes and records size
+    def __init__(self, f, path, mode, logger: EventLogger):
+        self._f = f
+        self._path = path
+        self._mode = mode
+        self._logger = logger
+        self._written = 0
+        self._hasher = _sha256()
+        self._seeked = False
+        self._closed = False
+        # bind hot passthrough methods directly so lookups hit the instance
+        # dict instead of falling back to the slow __getattr__ miss path
+        # (seek stays a real method: it must flag that the write stream no
+        # longer mirrors the file content)
+        self.flush = f.flush
+        self.tell = f.tell
+        self.fileno = f.fileno
+        self.read = f.read
+        self.readline = f.readline
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # dunders are looked up on the type, so these cannot be delegated
+        # through __getattr__; close() keeps the write-close event emission
+        self.close()
+        return False
+
+    def __iter__(self):
+        return iter(self._f)
+
+    def seek(self, *args, **kwargs):
+        # once the target seeks, written bytes can overlap, so the stream
+        # hash no longer equals the resulting file content
+        self._seeked = True
+        return self._f.seek(*args, **kwargs)
+
+    def write(self, b):
+        # support str and bytes
+        if isinstance(b, str):
+            b = b.encode()
+        self._written += len(b)
+        self._hasher.update(b)
+        return self._f.write(b)
+
+    def writelines(self, lines):
+        # collect everything through write for hashing
+        total = 0
+        for line in lines:
+            total += self.write(line)
+        return total
+
+    def close(self):
+        # closing twice is a no-op on real file objects; only the first
+        # close emits the write-close event (e.g. close() inside a with)
+        if self._closed:
+            return self._f.close()
+        self._closed = True
+        try:
+            return self._f.close()
+        finally:
+            if "w" in self._mode or "a" in self._mode or "x" in self._mode:
+                abspath = _abspath(self._path)
+                sha = self._hasher.hexdigest()
+                # for truncating/creating modes the written bytes are the
+                # whole file, so a later read of the same file can reuse this
+                # hash — unless a seek made writes overlap
+                if "a" not in self._mode and "+" not in self._mode and not self._seeked:
+                    try:
+                        st = os.stat(abspath)
+                        self._logger._written_hashes[abspath] = (self._written, sha, st.st_mtime_ns)
+                    except OSError:
+                        pass
+                self._logger.log(
+                    "file_write_close",
+                    path=abspath,
+                    bytes=self._written,
+                    sha256=sha,
+                )
+
+    def __getattr__(self, name):
+        # forward other attributes (read, flush, etc.)
+        return getattr(self._f, name)
+
+# memoize hash_file on file identity so repeated opens of the same file do
+# not re-read and re-hash identical content. mtime_ns and size change on any
+# write, so a stale entry can never be served; bounded lru to cap memory.
+# hash_file runs on the worker pool, so lru bookkeeping needs the lock.
+_HASH_CACHE: "OrderedDict[tuple, Tuple[int, str]]" = OrderedDict()
+_HASH_CACHE_MAX = 1024
+_hash_cache_lock = threading.Lock()
+
+# persistent cross-run variant of the same cache (the nix/ccache causal-hash
+# model): verify re-runs the same target against the same inputs, so a small
+# sqlite table keyed by file identity skips re-hashing unchanged files for
+# the cost of a microsecond lookup. hash workers run on pool threads, hence
+# the shared-connection lock.
+_HASH_DB_PATH = os.path.join(os.path.expanduser("~"), ".cache", "merklerun", "hashes.db")
+_hash_db: Optional[sqlite3.Connection] = None
+_hash_db_failed = False
+_hash_db_lock = threading.Lock()
+
+def _hash_db_conn() -> Optional[sqlite3.Connection]:
+    global _hash_db, _hash_db_failed
+    if _hash_db is None and not _hash_db_failed:
+        try:
+            os.makedirs(os.path.dirname(_HASH_DB_PATH), exist_ok=True)
+            conn = sqlite3.connect(_HASH_DB_PATH, check_same_thread=False)
+            conn.execute(
+                "create table if not exists hashes ("
+                "dev integer, ino integer, mtime_ns integer, size integer, sha256 text,"
+                "primary key (dev, ino, mtime_ns, size))"
+            )
+            _hash_db = conn
+        except (sqlite3.Error, OSError):
+            # an unusable cache dir must never break the run
+            _hash_db_failed = True
+    return _hash_db
+
+def _hash_db_get(st: os.stat_result) -> Optional[Tuple[int, str]]:
+    conn = _hash_db_conn()
+    if conn is None:
+        return None
+    try:
+        with _hash_db_lock:
+            row = conn.execute(
+                "select sha256 from hashes where dev=? and ino=? and mtime_ns=? and size=?",
+                (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size),
+            ).fetchone()
+    except sqlite3.Error:
+        return None
+    return (st.st_size, row[0]) if row else None
+
+def _hash_db_put(st: os.stat_result, sha: str):
+    conn = _hash_db_conn()
+    if conn is None:
+        return
+    try:
+        with _hash_db_lock:
+            conn.execute(
+                "insert or replace into hashes values (?, ?, ?, ?, ?)",
+                (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size, sha),
+            )
+            conn.commit()
+    except sqlite3.Error:
+        pass
+
+def hash_fd(fd: int, path: str) -> Tuple[int, str]:
+    # hash from an already-open descriptor and close it. the caller opens
+    # the fd at the moment the target opens the file, so a later unlink,
+    # rename or out-of-band rewrite cannot change the bytes this commits to.
+    try:
+        st = os.fstat(fd)
+        key = (path, st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+        with _hash_cache_lock:
+            cached = _HASH_CACHE.get(key)
+            if cached is not None:
+                _HASH_CACHE.move_to_end(key)
+                return cached
+        result = _hash_db_get(st)
+        if result is None:
+            result = _hash_fd_uncached(fd, st.st_size)
+            _hash_db_put(st, result[1])
+        with _hash_cache_lock:
+            _HASH_CACHE[key] = result
+            if len(_HASH_CACHE) > _HASH_CACHE_MAX:
+                _HASH_CACHE.popitem(last=False)
+        return result
+    finally:
+        os.close(fd)
+
+def hash_file(path: str) -> Tuple[int, str]:
+    # convenience wrapper for callers that only have a path
+    return hash_fd(os.open(path, os.O_RDONLY), _abspath(path))
+
+def _hash_fd_uncached(fd: int, size: int) -> Tuple[int, str]:
+    # hash file content entirely in c, without a python-level chunk loop.
+    # closefd=False leaves descriptor ownership with hash_fd.
+    with io.open(fd, "rb", closefd=False) as rf:
+        if hasattr(hashlib, "file_digest"):  # python 3.11+
+            return size, hashlib.file_digest(rf, _sha256).hexdigest()
+        # fallback for 3.10: a single update over an mmap, walked in c
+        h = _sha256()
+        if size:
+            with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+                h.update(mm)
+        return size, h.hexdigest()
+
+# open() keyword arguments the in-memory text wrap can honor; buffering,
+# closefd and opener change how the real file is opened, so they fall
+# back to a real second open
+_TEXT_WRAP_KWARGS = frozenset(("encoding", "errors", "newline"))
+
+class _NamedBytesIO(io.BytesIO):
+    # carries the source path like a real file object (TextIOWrapper exposes
+    # it as .name) and refuses writes, matching a read-only handle
+    def __init__(self, data: bytes, name: str):
+        super().__init__(data)
+        self.name = name
+
+    def writable(self):
+        return False
+
+    def write(self, b):
+        raise io.UnsupportedOperation("not writable")
+
+    def writelines(self, lines):
+        raise io.UnsupportedOperation("not writable")
+
+def _text_stream(data: bytes, abspath: str, mode: str, kwargs) -> io.TextIOWrapper:
+    # serve already-read bytes as a text file with the caller's options
+    f = io.TextIOWrapper(
+        _NamedBytesIO(data, abspath),
+        encoding=kwargs.get("encoding"),
+        errors=kwargs.get("errors"),
+        newline=kwargs.get("newline"),
+    )
+    # open() sets .mode on the wrapper it returns; mirror that
+    f.mode = mode
+    return f
+
+def patch_open(logger: EventLogger):
+    original_open = builtins.open
+    # mode strings form a small finite set per target, so partial-evaluate
+    # the mode checks once per distinct mode and dispatch specialized
+    # closures with no string containment tests on later opens
+    mode_cache: Dict[str, Any] = {}
+
+    def specialize(mode):
+        is_read = "r" in mode
+        is_plain_text = mode in ("r", "rt", "tr")
+        wraps_write = any(m in mode for m in ("w", "a", "x"))
+
+        def handler(path, args, kwargs):
+            abspath = _abspath(path)
+            # on read, hash the current file content for determinism; the
+            # hash itself runs on the worker pool (text mode hashes bytes too)
+            if is_read and os.path.exists(abspath):
+                # if this run already wrote the file, the write hash is the
+                # read hash — skip re-reading unless it changed since close
+                cached = logger._written_hashes.get(abspath)
+                if cached is not None and os.stat(abspath).st_mtime_ns == cached[2]:
+                    logger.defer_hash("file_open_read", lambda c=cached[:2]: c, path=abspath, mode=mode)
+                elif is_plain_text and not args and not (kwargs.keys() - _TEXT_WRAP_KWARGS):
+                    # plain text read: read the bytes once, hash them on the
+                    # pool, and serve the target from memory, not a re-read.
+                    # any positional argument is buffering, which the wrap
+                    # cannot honor, so that takes the real-open path below
+                    with io.open(abspath, "rb") as rf:
+                        data = rf.read()
+                    logger.defer_hash("file_open_read", lambda d=data: (len(d), _sha256(d).hexdigest()),
+                                      path=abspath, mode=mode)
+                    return _text_stream(data, abspath, mode, kwargs)
+                else:
+                    # pin the content with a private descriptor before the
+                    # target gets its handle: the worker hashes from this fd,
+                    # so nothing that happens to the path afterwards (unlink,
+                    # rename, a write bypassing builtins.open) can change
+                    # what the event commits to
+                    fd = os.open(abspath, os.O_RDONLY)
+                    logger.defer_hash("file_open_read", functools.partial(hash_fd, fd, abspath),
+                                      path=abspath, mode=mode)
+            else:
+                logger.log("file_open", path=abspath, mode=mode)
+
+            f = original_open(path, mode, *args, **kwargs)
+            # if writing, wrap to collect hash of written bytes
+            if wraps_write:
+                return IOShim(f, path, mode, logger)
+            return f
+
+        return handler
+
+    def open_wrapper(path, mode="r", *args, **kwargs):
+        handler = mode_cache.get(mode)
+        if handler is None:
+            handler = mode_cache[mode] = specialize(mode)
+        return handler(path, args, kwargs)
+
+    builtins.open = open_wrapper
+    return original_open
+
+def patch_socket(logger: EventLogger, allow_net: bool):
+    original_socket = socket.socket
+
+    class SocketShim(socket.socket):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            # streaming hashers per direction: update() folds each payload in
+            # and copy() finalizes a digest without resetting the stream, so
+            # every logged sha commits to the whole stream so far
+            self._send_hasher = _sha256()
+            self._recv_hasher = _sha256()
+
+        def connect(self, address):
+            # block or log network according to policy
+            host, port = address[0], address[1]
+            if not allow_net:
+                logger.log("net_block", host=host, port=port)
+                raise PermissionError("network disabled by merkle-run")
+            logger.log("net_connect", host=host, port=port)
+            return super().connect(address)
+
+        def send(self, data, *args, **kwargs):
+            if not allow_net:
+                logger.log("net_block_send", bytes=len(data))
+                raise PermissionError("network disabled by merkle-run")
+            # hash through a memoryview so no intermediate bytes object is built
+            try:
+                mv = memoryview(data).cast("B")
+            except TypeError:
+                mv = memoryview(str(data).encode())
+            self._send_hasher.update(mv)
+            logger.log("net_send", bytes=len(mv), sha256=self._send_hasher.copy().hexdigest())
+            return super().send(data, *args, **kwargs)
+
+        def recv(self, bufsize, *args, **kwargs):
+            if not allow_net:
+                logger.log("net_block_recv", req=bufsize)
+                raise PermissionError("network disabled by merkle-run")
+            data = super().recv(bufsize, *args, **kwargs)
+            self._recv_hasher.update(data)
+            logger.log("net_recv", bytes=len(data), sha256=self._recv_hasher.copy().hexdigest())
+            return data
+
+    socket.socket = SocketShim
+    return original_socket
+
+def patch_subprocess(logger: EventLogger):
+    original_popen = subprocess.Popen
+
+    # a plain wrapper function is enough to log spawns; it avoids the
+    # subclass __init__ dispatch and leaves the real class untouched for
+    # isinstance checks (reachable via __wrapped__)
+    @functools.wraps(original_popen, assigned=("__doc__",), updated=())
+    def popen_wrapper(args, *pargs, **kwargs):
+        # normalize args to a printable form
+        cmd = args if isinstance(args, list) else [str(args)]
+        logger.log("subprocess_spawn", cmd=" ".join(map(str, cmd)))
+        return original_popen(args, *pargs, **kwargs)
+
+    popen_wrapper.__wrapped__ = original_popen
+    subprocess.Popen = popen_wrapper
+    return original_popen
+
+def seed_all(seed: int, logger: EventLogger):
+    # fix python's prng; try numpy if present
+    random.seed(seed)
+    logger.log("rng_seed", lib="random", seed=seed)
+    try:
+        import numpy as np  # type: ignore
+        np.random.seed(seed)
+        logger.log("rng_seed", lib="numpy", seed=seed)
+    except Exception:
+        logger.log("rng_seed_skip", lib="numpy")
+
+# ----------------
+# core run/verify
+# ----------------
+
+def run_instrumented(target: str, args_line: Optional[str], seed: int, allow_net: bool,
+                     stream=None) -> Dict[str, Any]:
+    logger = EventLogger(seed=seed, allow_net=allow_net, stream=stream)
+
+    # apply patches
+    undo_open = patch_open(logger)
+    undo_sock = patch_socket(logger, allow_net)
+    undo_popen = patch_subprocess(logger)
+    seed_all(seed, logger)
+
+    # keep the cached cwd honest: invalidate it whenever the target chdirs
+    _invalidate_cwd_cache()
+    original_chdir = os.chdir
+
+    def chdir_wrapper(p):
+        original_chdir(p)
+        _invalidate_cwd_cache()
+
+    os.chdir = chdir_wrapper
+
+    # prepare argv for the target script
+    old_argv = sys.argv[:]
+    sys.argv = [target] + (args_line.split() if args_line else [])
+
+    try:
+        # run the target in its own globals using runpy
+        logger.log("begin", target=os.path.abspath(target), args=sys.argv[1:])
+        runpy.run_path(target, run_name="__main__")
+        logger.log("end", status="ok")
+    except Exception as e:
+        # log exception type and message (not stack) to keep manifest stable
+        logger.log("end", status="exception", error=repr(e))
+        raise
+    finally:
+        # restore patches
+        builtins.open = undo_open
+        socket.socket = undo_sock
+        subprocess.Popen = undo_popen
+        os.chdir = original_chdir
+        sys.argv = old_argv
+
+    return logger.manifest()
+
+def verify_run(target: str, ref_manifest_path: str, seed: int, allow_net: bool) -> Dict[str, Any]:
+    # load reference manifest
+    with open(ref_manifest_path, "r", encoding="utf-8") as f:
+        ref = json.load(f)
+
+    now = run_instrumented(target, args_line=" ".join(ref.get("events", [{}])[0].get("args", [])) if ref.get("events") else None,
+                           seed=seed, allow_net=allow_net)
+
+    # a manifest hashed under a different canonical form can never match our
+    # roots, so surface that as a diff instead of a silent root mismatch
+    diffs = []
+    ref_canon = ref.get("canonicalization")
+    if ref_canon is not None and ref_canon != _CANONICAL_FORM:
+        diffs.append({"index": "canonicalization", "field": "canonicalization",
+                      "ref": ref_canon, "now": _CANONICAL_FORM})
+
+    # compare event sequence shape and critical fields: extract them once
+    # into parallel tuples so the common all-equal case is a single c-level
+    # comparison per event, and only mismatches pay per-field dict lookups
+    a, b = ref["events"], now["events"]
+    fields = ("kind", "path", "sha256", "bytes", "cmd", "host", "port")
+    ta = [tuple(e.get(k) for k in fields) for e in a]
+    tb = [tuple(e.get(k) for k in fields) for e in b]
+    for i, (ra, rb) in enumerate(zip(ta, tb)):
+        if ra == rb:
+            continue
+        if ra[0] != rb[0]:
+            diffs.append({"index": i, "field": "kind", "ref": ra[0], "now": rb[0]})
+            continue
+        for key, va, vb in zip(fields, ra, rb):
+            if va != vb:
+                diffs.append({"index": i, "field": key, "ref": va, "now": vb})
+    if len(a) != len(b):
+        diffs.append({"index": "len", "ref": len(a), "now": len(b)})
+
+    return {"ok": len(diffs) == 0, "diffs": diffs, "reference_root": ref.get("root_hash"), "now_root": now.get("root_hash")}
+
+# ------------
+# handy cli
+# ------------
+
+def main():
+    parser = argparse.ArgumentParser(description="merkle-run: deterministic, tamper-evident runner")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_run = sub.add_parser("run", help="run a script and emit manifest.json")
+    p_run.add_argument("target")
+    p_run.add_argument("--args", default=None, help="args passed to target script (single string)")
+    p_run.add_argument("--seed", type=int, default=1337)
+    p_run.add_argument("--allow-net", type=int, default=0)
+    p_run.add_argument("--out", default="manifest.json")
+
+    p_ver = sub.add_parser("verify", help="re-run script and compare against a reference manifest")
+    p_ver.add_argument("target")
+    p_ver.add_argument("reference_manifest")
+    p_ver.add_argument("--seed", type=int, default=1337)
+    p_ver.add_argument("--allow-net", type=int, default=0)
+
+    p_diff = sub.add_parser("diff", help="compare two manifests")
+    p_diff.add_argument("a")
+    p_diff.add_argument("b")
+
+    args = parser.parse_args()
+
+    if args.cmd == "run":
+        # stream events into a temp file as they happen, then publish it
+        # atomically: a failing run (the stream stops mid-array) must never
+        # clobber an existing manifest with truncated json
+        tmp_out = args.out + ".tmp"
+        try:
+            with open(tmp_out, "w", encoding="utf-8") as f:
+                manifest = run_instrumented(args.target, args.args, seed=args.seed,
+                                            allow_net=bool(args.allow_net), stream=f)
+        except BaseException:
+            try:
+                os.remove(tmp_out)
+            except OSError:
+                pass
+            raise
+        os.replace(tmp_out, args.out)
+        print(f"wrote {args.out} with root_hash {manifest['root_hash']}")
+    elif args.cmd == "verify":
+        result = verify_run(args.target, args.reference_manifest, seed=args.seed, allow_net=bool(args.allow_net))
+        print(json.dumps(result, indent=2, sort_keys=True))
+        if not result["ok"]:
+            sys.exit(2)
+    elif args.cmd == "diff":
+        with open(args.a, "r", encoding="utf-8") as fa, open(args.b, "r", encoding="utf-8") as fb:
+            A, B = json.load(fa), json.load(fb)
+        print("root a:", A.get("root_hash"))
+        print("root b:", B.get("root_hash"))
+        # simple diff by event count and kinds
+        kinds_a = [e["kind"] for e in A.get("events", [])]
+        kinds_b = [e["kind"] for e in B.get("events", [])]
+        print("len a:", len(kinds_a), "len b:", len(kinds_b))
+        for i, (ka, kb) in enumerate(zip(kinds_a, kinds_b)):
+            if ka != kb:
+                print(f"@{i}: {ka} != {kb}")
+
+if __name__ == "__main__":
+    main()